@@ -3,13 +3,23 @@
 
 import os
 import re
-import time
 import argparse
+import functools
 import subprocess
 from datetime import datetime
 from pathlib import Path
-from itertools import zip_longest
-from watchlogs.watchlogs import Watcher
+from concurrent.futures import ThreadPoolExecutor
+
+
+_TEMPLATE_RE = re.compile(r"\{\{.*?\}\}")
+
+
+@functools.lru_cache(maxsize=64)
+def _load_template(path_str, mtime_ns):
+    """Read a template file, memoizing on its path and modification time so that
+    repeated fills of the same (unmodified) template skip the disk read."""
+    with open(path_str, "r") as f:
+        return f.read()
 
 
 class Yaspi:
@@ -54,7 +64,7 @@ class Yaspi:
             )
         if self.recipe == "ray":
             # TODO(Samuel): configure this more sensibly
-            template_paths = {
+            template_names = {
                 "master": "ray/ray-master.sh",
                 "sbatch": "ray/ray-sbatch.sh",
                 "head-node": "ray/start-ray-head-node.sh",
@@ -73,41 +83,45 @@ class Yaspi:
             array_str = f"1-{self.job_array_size}"
             if self.throttle_array:
                 array_str = f"{array_str}%{self.throttle_array}"
-            rules = {
-                "master": {
-                    "nfs_update_secs": 1,
-                    "ray_sbatch_path": str(gen_dir / template_paths["sbatch"]),
-                },
-                "sbatch": {
-                    "cmd": self.cmd,
-                    "mem": self.mem,
-                    "log_path": self.log_path,
-                    "job_name": self.job_name,
-                    "partition": self.partition,
-                    "time_limit": self.time_limit,
-                    "env_setup": self.env_setup,
-                    "array": array_str,
-                    "cpus_per_task": self.cpus_per_task,
-                    "approx_ray_init_time_in_secs": 10,
-                    "exclude_nodes": f"#SBATCH --exclude={self.exclude}",
-                    "head_init_script": str(gen_dir / template_paths["head-node"]),
-                    "worker_init_script": str(gen_dir / template_paths["worker-node"]),
-                    "ssh_forward": self.ssh_forward,
-                },
-                "head-node": {
-                    "ray_args": ray_args,
-                    "env_setup": self.env_setup,
-                },
-                "worker-node": {
-                    "ray_args": ray_args,
-                    "env_setup": self.env_setup,
-                },
+            # generated-script locations referenced by the rules below
+            abs_paths = {key: str(gen_dir / name)
+                         for key, name in template_names.items()}
+            # head-node and worker-node consume identical rules, so share one dict
+            env_rules = {
+                "ray_args": ray_args,
+                "env_setup": self.env_setup,
             }
-            if self.gpus_per_task:
-                resource_str = f"#SBATCH --gres=gpu:{self.gpus_per_task}"
-            if self.constraint_str:
-                resource_str = f"{resource_str}\n{self.constraint_str}"
-                rules["sbatch"]["sbatch_resources"] = resource_str
+
+            def _rules_for(key):
+                if key == "master":
+                    return {
+                        "nfs_update_secs": 1,
+                        "ray_sbatch_path": abs_paths["sbatch"],
+                    }
+                if key == "sbatch":
+                    sbatch_rules = {
+                        "cmd": self.cmd,
+                        "mem": self.mem,
+                        "log_path": self.log_path,
+                        "job_name": self.job_name,
+                        "partition": self.partition,
+                        "time_limit": self.time_limit,
+                        "env_setup": self.env_setup,
+                        "array": array_str,
+                        "cpus_per_task": self.cpus_per_task,
+                        "approx_ray_init_time_in_secs": 10,
+                        "exclude_nodes": f"#SBATCH --exclude={self.exclude}",
+                        "head_init_script": abs_paths["head-node"],
+                        "worker_init_script": abs_paths["worker-node"],
+                        "ssh_forward": self.ssh_forward,
+                    }
+                    if self.gpus_per_task:
+                        resource_str = f"#SBATCH --gres=gpu:{self.gpus_per_task}"
+                    if self.constraint_str:
+                        resource_str = f"{resource_str}\n{self.constraint_str}"
+                        sbatch_rules["sbatch_resources"] = resource_str
+                    return sbatch_rules
+                return env_rules
         elif self.recipe in {"cpu-proc", "gpu-proc"}:
             if self.env_setup is None:
                 # TODO(Samuel): configure this more sensibly
@@ -117,7 +131,7 @@ class Yaspi:
                     'source ~/local/anaconda3/etc/profile.d/conda.sh\n'
                     'conda activate pt14'
                 )
-            template_paths = {
+            template_names = {
                 "master": f"{self.recipe}/master.sh",
                 "sbatch": f"{self.recipe}/template.sh",
             }
@@ -126,11 +140,19 @@ class Yaspi:
             array_str = f"1-{self.job_array_size}"
             if self.throttle_array:
                 array_str = f"{array_str}%{self.throttle_array}"
-            rules = {
-                "master": {
-                    "sbatch_path": str(gen_dir / template_paths["sbatch"]),
-                },
-                "sbatch": {
+            sbatch_path = str(gen_dir / template_names["sbatch"])
+
+            def _rules_for(key):
+                if key == "master":
+                    return {
+                        "sbatch_path": sbatch_path,
+                    }
+                resource_strs = []
+                if self.constraint_str:
+                    resource_strs.append(f"#SBATCH --constraint={self.constraint_str}")
+                if self.gpus_per_task and self.recipe == "gpu-proc":
+                    resource_strs.append(f"#SBATCH --gres=gpu:{self.gpus_per_task}")
+                return {
                     "cmd": self.cmd,
                     "mem": self.mem,
                     "prep": self.prep,
@@ -143,62 +165,71 @@ class Yaspi:
                     "time_limit": self.time_limit,
                     "cpus_per_task": self.cpus_per_task,
                     "exclude_nodes": f"#SBATCH --exclude={self.exclude}",
-                    "sbatch_resources": "",
-                },
-            }
-            resource_strs = []
-            if self.constraint_str:
-                resource_strs.append(f"#SBATCH --constraint={self.constraint_str}")
-            if self.gpus_per_task and self.recipe == "gpu-proc":
-                resource_strs.append(f"#SBATCH --gres=gpu:{self.gpus_per_task}")
-            rules["sbatch"]["sbatch_resources"] = "\n".join(resource_strs)
+                    "sbatch_resources": "\n".join(resource_strs),
+                }
         else:
             raise ValueError(f"template: {self.recipe} unrecognised")
 
-        template_paths = {key: Path(self.template_dir) / val
-                          for key, val in template_paths.items()}
+        tpl_dir = Path(self.template_dir)
+        template_paths = {key: (tpl_dir / val, Path(val))
+                          for key, val in template_names.items()}
 
-        self.gen_scripts = {}
-        for key, template_path in template_paths.items():
-            gen = self.fill_template(template_path=template_path, rules=rules[key])
-            dest_path = gen_dir / Path(template_path).relative_to(self.template_dir)
-            self.gen_scripts[key] = dest_path
-            dest_path.parent.mkdir(exist_ok=True, parents=True)
-            with open(str(dest_path), "w") as f:
-                print(f"Writing slurm script ({key}) to {dest_path}")
-                f.write(gen)
-            dest_path.chmod(0o755)
+        # all destination dirs are known up front, so create them before the loop
+        for parent in {(gen_dir / rel_path).parent
+                       for _, rel_path in template_paths.values()}:
+            parent.mkdir(exist_ok=True, parents=True)
+
+        self.gen_scripts = {key: gen_dir / rel_path
+                            for key, (_, rel_path) in template_paths.items()}
+
+        def _generate(key):
+            dest_path = self.gen_scripts[key]
+            print(f"Writing slurm script ({key}) to {dest_path}")
+            self.fill_template(template_path=template_paths[key][0],
+                               dest_path=dest_path, rules=_rules_for(key))
+
+        # each template is an independent read-substitute-write pipeline, so the
+        # file I/O can be overlapped across a small thread pool
+        with ThreadPoolExecutor(max_workers=len(template_paths)) as pool:
+            list(pool.map(_generate, template_paths))
 
     def get_log_paths(self):
         watched_logs = []
+        log_tmpl = str(self.log_path)
+        # every watched log shares the same parent directory, so create it once
+        parent = Path(log_tmpl.replace("%4a", "0001")).parent
+        parent.mkdir(exist_ok=True, parents=True)
+        # a single readdir replaces a stat syscall per array task
+        existing = {entry.name for entry in os.scandir(parent)}
         for idx in range(self.job_array_size):
             if self.recipe == "ray" and idx > 0:
                 # for ray jobs, we only need to watch the log from the headnode
                 break
-            slurm_id = idx + 1
-            watched_log = Path(str(self.log_path).replace("%4a", f"{slurm_id:04d}"))
-            watched_log.parent.mkdir(exist_ok=True, parents=True)
-            if self.refresh_logs:
-                if watched_log.exists():
-                    watched_log.unlink()
-                    # We also remove Pygtail files
-                    pygtail_file = watched_log.with_suffix(".txt.offset")
-                    if pygtail_file.exists():
-                        pygtail_file.unlink()
+            watched_log = log_tmpl.replace("%4a", f"{idx + 1:04d}")
+            fname = os.path.basename(watched_log)
+            if self.refresh_logs and fname in existing:
+                os.unlink(watched_log)
+                existing.discard(fname)
+                # We also remove Pygtail files
+                pygtail_file = os.path.splitext(watched_log)[0] + ".txt.offset"
+                if os.path.basename(pygtail_file) in existing:
+                    os.unlink(pygtail_file)
             # We must make sure that the log file exists to enable monitoring
-            if not watched_log.exists():
+            if fname not in existing:
                 print(f"Creating watch log: {watched_log} for the first time")
-                watched_log.touch()
-            watched_logs.append(str(watched_log.resolve()))
+                open(watched_log, "a").close()
+            watched_logs.append(os.path.realpath(watched_log))
         return watched_logs
 
     def submit(self, watch=True, conserve_resources=5):
         if watch:
             watched_logs = self.get_log_paths()
-        submission_cmd = f"source {self.gen_scripts['master']}"
-        print(f"Submitting job with command: {submission_cmd}")
-        os.system(submission_cmd)
+        submission_cmd = ["bash", str(self.gen_scripts["master"])]
+        print(f"Submitting job with command: {' '.join(submission_cmd)}")
+        subprocess.run(submission_cmd, check=True)
         if watch:
+            # deferred import: watchlogs is only needed when watching logs
+            from watchlogs.watchlogs import Watcher
             Watcher(
                 heartbeat=True,
                 conserve_resources=conserve_resources,
@@ -217,42 +248,30 @@ class Yaspi:
             summary += f"{key}: {val}\n"
         return summary
 
-    def fill_template(self, template_path, rules):
-        """Transform a template according to a given set of rules.
+    def fill_template(self, template_path, dest_path, rules):
+        """Transform a template according to a given set of rules and write the
+        result to a destination file.
 
         Args:
             template_path (str): location of the template to be filled.
+            dest_path (str): location where the filled template will be written.
             rules (dict[str:object]): a key, value mapping between template keys
                 and their target values.
-
-        Returns:
-            (str): a single string represnting the transformed contents of the template
-                file.
         """
-        generated = []
-        with open(template_path, "r") as f:
-            template = f.read().splitlines()
-        for row in template:
-            edits = []
-            regex = r"\{\{(.*?)\}\}"
-            for match in re.finditer(regex, row):
-                groups = match.groups()
-                assert len(groups) == 1, "expected single group"
-                key = groups[0]
-                token = rules[key]
-                edits.append((match.span(), token))
-            if edits:
-                # invert the spans
-                spans = [(None, 0)] + [x[0] for x in edits] + [(len(row), None)]
-                inverse_spans = [(x[1], y[0]) for x, y in zip(spans, spans[1:])]
-                tokens = [row[start:stop] for start, stop in inverse_spans]
-                urls = [str(x[1]) for x in edits]
-                new_row = ""
-                for token, url in zip_longest(tokens, urls, fillvalue=""):
-                    new_row += token + url
-                row = new_row
-            generated.append(row)
-        return "\n".join(generated)
+        template_path = Path(template_path)
+        template = _load_template(str(template_path), template_path.stat().st_mtime_ns)
+        if "{{" in template:
+            # match.group() is the full {{key}} token, so slice off the braces
+            generated = _TEMPLATE_RE.sub(lambda match: str(rules[match.group()[2:-2]]),
+                                         template)
+        else:
+            generated = template
+        # set the executable bits at creation time rather than with a follow-up chmod
+        fd = os.open(str(dest_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+        try:
+            os.write(fd, generated.encode())
+        finally:
+            os.close(fd)
 
 
 def main():